@@ -1,27 +1,25 @@
 import google.generativeai as genai
+from google.api_core import exceptions as gexc
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential_jitter
 import os
-import json
+import re
+import orjson
 import time
+import hashlib
+import tempfile
+import threading
 
 # Configurable model name
 # Configurable model name
 MODEL_NAME = "gemini-3-flash-preview" # Corrected ID from user logs
 
-def init_gemini(api_key):
-    genai.configure(api_key=api_key)
+# Verdicts are cached by image content hash so re-runs skip Gemini entirely
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+CACHE_DIR = os.path.join(os.path.dirname(SCRIPT_DIR), "data", "analysis_cache")
 
-def analyze_image(image_path, model_name=MODEL_NAME):
-    """
-    Uses Gemini to analyze if the image is a high-quality methodology diagram.
-    """
-    try:
-        model = genai.GenerativeModel(model_name)
-        
-        # Upload the file
-        myfile = genai.upload_file(image_path)
-        
-        prompt = """
-        Analyze this image. I am building a dataset of high-quality scientific **Methodology Diagrams** and **Model Architectures**.
+# Static instructions, defined once and set as the model's system instruction
+SYSTEM_PROMPT = """
+        I am building a dataset of high-quality scientific **Methodology Diagrams** and **Model Architectures**.
         
         STRICT Criteria for "Methodology Diagram":
         1. **YES**: High-level system architectures, neural network diagrams, flowcharts of the proposed method, algorithm pipelines.
@@ -39,8 +37,9 @@ def analyze_image(image_path, model_name=MODEL_NAME):
         - "visual_style": The design style (e.g., "flat 2D", "isometric 3D", "minimalist line art", "colorful gradient").
         - "keywords": A list of 5-8 relevant technical tags (e.g., "transformer", "attention mechanism", "encoder-decoder").
 
-        Return a valid JSON object (no markdown formatting) with these fields:
+        For every image, produce a JSON object with these fields:
         {
+            "index": number,
             "is_methodology": boolean,
             "quality_score": number (1-10),
             "description": "short description",
@@ -50,34 +49,221 @@ def analyze_image(image_path, model_name=MODEL_NAME):
             "keywords": ["tag1", "tag2"]
         }
         """
-        
-        # Wait for file to be ready
-        while myfile.state.name == "PROCESSING":
-             time.sleep(1)
-             myfile = genai.get_file(myfile.name)
 
-        if myfile.state.name == "FAILED":
-             raise ValueError("File upload failed.")
+# Per-request instruction sent alongside the images
+BATCH_PROMPT = """
+        Analyze these {n} images. Judge each image independently.
+        Return a valid JSON array (no markdown formatting) of length {n}.
+        Element i corresponds to image i (0-based, in the order given).
+        """
+
+# Cache entries are namespaced by model + prompt so edits to either invalidate old verdicts
+PROMPT_VERSION = hashlib.sha256((SYSTEM_PROMPT + BATCH_PROMPT).encode("utf-8")).hexdigest()[:12]
+
+# Shared model client, created once in init_gemini and reused by every call
+_MODEL = None
+_MODEL_LOCK = threading.Lock()
+
+def _build_model(model_name=MODEL_NAME):
+    return genai.GenerativeModel(model_name, system_instruction=SYSTEM_PROMPT)
+
+def init_gemini(api_key):
+    global _MODEL
+    genai.configure(api_key=api_key)
+    with _MODEL_LOCK:
+        if _MODEL is None:
+            _MODEL = _build_model()
+
+def _get_model(model_name):
+    global _MODEL
+    if model_name != MODEL_NAME:
+        return _build_model(model_name)
+    if _MODEL is None:
+        with _MODEL_LOCK:
+            if _MODEL is None:
+                _MODEL = _build_model()
+    return _MODEL
+
+# Transient Gemini errors worth retrying; anything else (e.g. 404) fails fast
+RETRYABLE_ERRORS = (gexc.ResourceExhausted, gexc.ServiceUnavailable, gexc.DeadlineExceeded)
+
+@retry(stop=stop_after_attempt(5),
+       wait=wait_exponential_jitter(initial=1, max=30),
+       retry=retry_if_exception_type(RETRYABLE_ERRORS),
+       reraise=True)
+def _generate(model, contents):
+    return model.generate_content(contents)
+
+def _error_result():
+    return {"is_methodology": False, "quality_score": 0, "reason": "Error"}
+
+def image_hash(image_path):
+    """SHA-256 of the file contents, or None if it can't be read."""
+    try:
+        with open(image_path, 'rb') as f:
+            return hashlib.sha256(f.read()).hexdigest()
+    except OSError as e:
+        print(f"[!] Could not hash {os.path.basename(image_path)}: {e}")
+        return None
+
+def _cache_dir(model_name):
+    safe_model = re.sub(r'[^\w\-.]', '_', model_name)
+    return os.path.join(CACHE_DIR, f"{safe_model}-{PROMPT_VERSION}")
+
+def load_cached(h, model_name=MODEL_NAME):
+    """Returns the cached verdict for hash h under model_name, or None on miss."""
+    cache_path = os.path.join(_cache_dir(model_name), h + ".json")
+    if not os.path.exists(cache_path):
+        return None
+    try:
+        with open(cache_path, 'rb') as f:
+            return orjson.loads(f.read())
+    except Exception:
+        return None
+
+def save_cached(h, result, model_name=MODEL_NAME):
+    """Writes verdict atomically (tempfile + os.replace)."""
+    cache_dir = _cache_dir(model_name)
+    os.makedirs(cache_dir, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(orjson.dumps(result, option=orjson.OPT_INDENT_2))
+        os.replace(tmp_path, os.path.join(cache_dir, h + ".json"))
+    except Exception as e:
+        print(f"[!] Could not write cache entry {h[:12]}: {e}")
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+
+def analyze_images_batch(image_paths, model_name=MODEL_NAME, use_cache=True):
+    """
+    Returns a list of result dicts, one per entry in image_paths (same order).
+    Cached verdicts are reused; only cache misses are sent to Gemini.
+    """
+    if not image_paths:
+        return []
+
+    if not use_cache:
+        return _analyze_uncached(image_paths, model_name)
+
+    # Unreadable images (hash None) are treated as misses and never cached
+    hashes = [image_hash(p) for p in image_paths]
+    results = [load_cached(h, model_name) if h else None for h in hashes]
+    misses = [i for i, r in enumerate(results) if r is None]
+
+    if misses:
+        fresh = _analyze_uncached([image_paths[i] for i in misses], model_name)
+        for i, r in zip(misses, fresh):
+            results[i] = r
+            # Never cache error placeholders
+            if hashes[i] and r.get("reason") != "Error":
+                save_cached(hashes[i], r, model_name)
+
+    return results
 
-        result = model.generate_content([myfile, prompt])
+def _upload_all(image_paths):
+    """
+    Uploads all files and waits for them in a single polling loop.
+    Returns a list aligned with image_paths; None where an upload failed.
+    """
+    files = []
+    for p in image_paths:
+        try:
+            files.append(genai.upload_file(p))
+        except Exception as e:
+            print(f"[!] Upload failed for {os.path.basename(p)}: {e}")
+            files.append(None)
+
+    while any(f is not None and f.state.name == "PROCESSING" for f in files):
+        time.sleep(1)
+        files = [genai.get_file(f.name) if f is not None and f.state.name == "PROCESSING" else f
+                 for f in files]
+
+    return [None if f is None or f.state.name == "FAILED" else f for f in files]
+
+def _request(model, files):
+    """
+    Sends one generate_content call for the given uploaded files.
+    Returns one result dict per file; raises ValueError on a malformed response.
+    """
+    result = _generate(model, files + [BATCH_PROMPT.format(n=len(files))])
+    
+    # Clean response to get JSON
+    text = result.text.strip()
+    if text.startswith("```json"):
+        text = text[7:-3].strip()
+    elif text.startswith("```"):
+        text = text[3:-3].strip()
         
-        # Clean response to get JSON
-        text = result.text.strip()
-        if text.startswith("```json"):
-            text = text[7:-3].strip()
-        elif text.startswith("```"):
-            text = text[3:-3].strip()
-            
-        return json.loads(text)
+    parsed = orjson.loads(text)
+    if isinstance(parsed, dict):
+        parsed = [parsed]
+    if len(parsed) != len(files) or not all(isinstance(item, dict) for item in parsed):
+        raise ValueError(f"Expected {len(files)} result objects, got {len(parsed)} items.")
 
+    # Honor the explicit "index" field if the model reordered elements
+    indices = [item.get("index") for item in parsed]
+    if sorted(i for i in indices if isinstance(i, int)) == list(range(len(parsed))):
+        parsed = [item for _, item in sorted(zip(indices, parsed), key=lambda x: x[0])]
+    return parsed
+
+def _report_failure(e, model_name):
+    """Logs an analysis error. Returns True if the error means the model is missing."""
+    print(f"[!] Analysis failed: {e}")
+    model_missing = "404" in str(e) or "not found" in str(e).lower()
+    if model_missing:
+        print(f"    [Hint] Model '{model_name}' might not exist. Available models:")
+        try:
+            for m in genai.list_models():
+                if 'generateContent' in m.supported_generation_methods:
+                    print(f"      - {m.name}")
+        except:
+            pass
+    return model_missing
+
+def _analyze_uncached(image_paths, model_name=MODEL_NAME):
+    """
+    Uses Gemini to analyze a batch of images in a single request.
+    If the batch response is unusable (unparseable or wrong-length), the
+    already-uploaded files are re-asked one at a time. Rate-limit/outage
+    errors and a missing model are not retried per image.
+    """
+    results = [_error_result() for _ in image_paths]
+    try:
+        model = _get_model(model_name)
+        files = _upload_all(image_paths)
+    except Exception as e:
+        _report_failure(e, model_name)
+        return results
+
+    # Failed uploads keep their error placeholder
+    ready = [i for i, f in enumerate(files) if f is not None]
+    if not ready:
+        return results
+
+    try:
+        for i, r in zip(ready, _request(model, [files[i] for i in ready])):
+            results[i] = r
+        return results
     except Exception as e:
-        print(f"[!] Analysis failed: {e}")
-        if "404" in str(e) or "not found" in str(e).lower():
-            print(f"    [Hint] Model '{model_name}' might not exist. Available models:")
-            try:
-                for m in genai.list_models():
-                    if 'generateContent' in m.supported_generation_methods:
-                        print(f"      - {m.name}")
-            except:
-                pass
-        return {"is_methodology": False, "quality_score": 0, "reason": "Error"}
+        if _report_failure(e, model_name) or isinstance(e, RETRYABLE_ERRORS) or len(ready) == 1:
+            return results
+
+    # A malformed/short array shouldn't sink the whole batch
+    print(f"    [*] Retrying {len(ready)} images one at a time...")
+    for i in ready:
+        try:
+            results[i] = _request(model, [files[i]])[0]
+        except Exception as e:
+            if _report_failure(e, model_name) or isinstance(e, RETRYABLE_ERRORS):
+                break
+    return results
+
+def analyze_image(image_path, model_name=MODEL_NAME, use_cache=True):
+    """
+    Uses Gemini to analyze if the image is a high-quality methodology diagram.
+    Thin wrapper around analyze_images_batch for single images.
+    """
+    return analyze_images_batch([image_path], model_name, use_cache)[0]
@@ -1,4 +1,7 @@
 import arxiv
+import asyncio
+import httpx
+import io
 import os
 import requests
 
@@ -6,7 +9,8 @@ def fetch_papers(query, max_results=5, saved_ids=None):
     """
     Fetches papers from ArXiv based on query.
     Returns list of dicts: {'id': ..., 'title': ..., 'pdf_url': ...}
-    Skipping those in saved_ids.
+    Skipping those in saved_ids. Always starts from the newest submissions;
+    results are paged lazily, so only as many pages are fetched as needed.
     """
     if saved_ids is None:
         saved_ids = set()
@@ -15,7 +19,7 @@ def fetch_papers(query, max_results=5, saved_ids=None):
     client = arxiv.Client()
     search = arxiv.Search(
         query=query,
-        max_results=1000, # Large buffer to skip over many existing/duplicate papers
+        max_results=None, # No cap: the generator stops once we have enough new papers
         sort_by=arxiv.SortCriterion.SubmittedDate
     )
 
@@ -46,15 +50,41 @@ def fetch_papers(query, max_results=5, saved_ids=None):
             
     return results
 
-def download_pdf(url, save_path):
-    """Downloads PDF to save_path."""
+def download_pdf(url):
+    """Downloads PDF into memory. Returns the raw bytes, or None on failure."""
     try:
         response = requests.get(url, stream=True)
         response.raise_for_status()
-        with open(save_path, 'wb') as f:
-            for chunk in response.iter_content(chunk_size=8192):
-                f.write(chunk)
-        return True
+        buf = io.BytesIO()
+        for chunk in response.iter_content(chunk_size=8192):
+            buf.write(chunk)
+        return buf.getvalue()
     except Exception as e:
         print(f"[!] Failed to download {url}: {e}")
-        return False
+        return None
+
+async def _download_one(client, sem, paper, on_downloaded):
+    # The slot is held until the consumer has taken the PDF, so at most
+    # `concurrency` downloaded-but-unconsumed PDFs exist at any time
+    async with sem:
+        print(f"\n[=] Downloading: {paper['title']} ({paper['id']})", flush=True)
+        try:
+            response = await client.get(paper['pdf_url'])
+            response.raise_for_status()
+            pdf_bytes = response.content
+        except Exception as e:
+            print(f"[!] Failed to download {paper['pdf_url']}: {e}")
+            pdf_bytes = None
+        await asyncio.to_thread(on_downloaded, paper, pdf_bytes)
+
+async def download_all(papers, on_downloaded, concurrency=8):
+    """
+    Downloads all papers' PDFs concurrently over one HTTP/2 client.
+    Calls on_downloaded(paper, pdf_bytes) from a worker thread as each
+    finishes (pdf_bytes is None on failure), so a blocking consumer
+    does not stall the event loop. A blocked consumer also holds back
+    further downloads, bounding memory to `concurrency` PDFs.
+    """
+    sem = asyncio.Semaphore(concurrency)
+    async with httpx.AsyncClient(http2=True, follow_redirects=True, timeout=60) as client:
+        await asyncio.gather(*(_download_one(client, sem, p, on_downloaded) for p in papers))
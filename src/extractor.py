@@ -1,91 +1,231 @@
 import fitz  # PyMuPDF
+import numpy as np
 import os
 import re
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+# Per-page extraction is CPU-bound native MuPDF work; 4-6 workers is the sweet spot
+MAX_PAGE_WORKERS = 4
+PAGE_WORKERS = min(os.cpu_count() or 1, MAX_PAGE_WORKERS)
+
+# Candidates are probed at PROBE_DPI and only keepers are rendered at RENDER_DPI
+PROBE_DPI = 72
+RENDER_DPI = 150
+
+# Figures whose subsampled pixels are mostly distinct colors are saved as JPEG
+PHOTO_UNIQUE_RATIO = 0.25
+JPEG_QUALITY = 90
+IMAGE_EXTENSIONS = (".png", ".jpg")
+
+# Empty MuPDF's object/render store after every N pages a worker processes
+STORE_FLUSH_INTERVAL = 8
+
+# Lean text extraction: no ligature expansion, no image blocks (only text blocks are used)
+TEXT_FLAGS = fitz.TEXT_PRESERVE_WHITESPACE | fitz.TEXT_MEDIABOX_CLIP
+
+# Captions usually start with "Figure X" / "Fig. X"
+CAPTION_PATTERN = re.compile(r'^(Fig\.?|Figure)\s*\d+', re.IGNORECASE)
 
 def get_page_elements(page):
     """
-    Scans page and categorizes elements into Captions, Body Text, and Visuals.
+    Scans page and categorizes elements into Captions, Body Text, and raster Visuals.
+    Vector drawings are fetched separately by get_drawing_visuals.
     """
     captions = []
     body_text = []
     
     # 1. Text Analysis
-    text_blocks = page.get_text("blocks")
-    caption_pattern = re.compile(r'^(Fig\.?|Figure)\s*\d+', re.IGNORECASE)
+    text_blocks = page.get_text("blocks", flags=TEXT_FLAGS)
     
     for block in text_blocks:
         # block: (x0, y0, x1, y1, text, block_no, type)
-        if block[6] == 0: # Text
-            text = block[4].strip()
-            r = fitz.Rect(block[:4])
-            
-            # Simple heuristic: Captions usually start with "Figure X"
-            # Note: Sometimes caption text is split across blocks. 
-            # We assume the block *starting* with "Figure" is the anchor.
-            if caption_pattern.match(text):
-                captions.append((r, text))
-            else:
-                # Treat everything else as body text potential barrier
-                # Filter out headers/footers if possible (y < 50 or y > h-50?)
-                # For now, trust raw blocks.
-                body_text.append(r)
-
-    # 2. Visuals (Images + Drawings)
+        if block[6] != 0: # Not text
+            continue
+
+        # Simple heuristic: Captions usually start with "Figure X"
+        # Note: Sometimes caption text is split across blocks. 
+        # We assume the block *starting* with "Figure" is the anchor.
+        # Only captions need their text; match on the raw string first.
+        text = block[4]
+        if CAPTION_PATTERN.match(text.lstrip()):
+            captions.append((fitz.Rect(block[:4]), text.strip()))
+        else:
+            # Treat everything else as body text potential barrier
+            # Filter out headers/footers if possible (y < 50 or y > h-50?)
+            # For now, trust raw blocks.
+            body_text.append(fitz.Rect(block[:4]))
+
+    # 2. Visuals (Images; drawings come from get_drawing_visuals)
     visuals = []
     
     # Images
     for info in page.get_image_info(xrefs=True):
         visuals.append(fitz.Rect(info['bbox']))
         
-    # Vector Drawings (Rects, lines for diagrams)
-    # drawings = page.get_drawings()
-    # for d in drawings:
-    #     visuals.append(d["rect"])
-    # Note: Drawings often include borders/underlines which mess up bounding boxes.
-    # For now, relying on images is safer for "methodology" diagrams which are usually bitmaps.
-    # If the user's diagram is pure vector (PDF stream), we might miss it without get_drawings.
-    # Let's enable drawings but be careful filtering small ones.
+    return captions, body_text, visuals
+
+def get_drawing_visuals(page):
+    """
+    Vector Drawings (Rects, lines for diagrams).
+    Note: Drawings often include borders/underlines which mess up bounding boxes.
+    For now, relying on images is safer for "methodology" diagrams which are usually bitmaps.
+    If the user's diagram is pure vector (PDF stream), we might miss it without get_drawings.
+    get_drawings() walks the whole vector content stream, so callers only use it
+    when some caption's candidate box contains no raster image.
+    """
+    visuals = []
+    max_width = page.rect.width - 20
     for p in page.get_drawings():
         r = p["rect"]
         # Filter tiny specs or full page borders
-        if r.width > 20 and r.height > 20 and r.width < page.rect.width - 20:
+        if r.width > 20 and r.height > 20 and r.width < max_width:
              visuals.append(r)
+    return visuals
 
-    return captions, body_text, visuals
+def caption_column(cap_rect, page_width):
+    """
+    Horizontal search bounds (x_min, x_max) for the figure above a caption.
+    If caption is wide (> 60% page width), search full width.
+    If caption is narrow, search roughly that column (+ buffer).
+    """
+    if cap_rect.width > (page_width * 0.6):
+        return 0, page_width
+    return cap_rect.x0 - 20, cap_rect.x1 + 20
+
+def _visuals_in_box(vis_arr, cap_rect, x_min, x_max, y_ceiling):
+    """
+    Indices into vis_arr (sorted by y0) of visuals inside a caption's candidate box.
+    """
+    # Check 1: Must be largely above caption
+    n_above = np.searchsorted(vis_arr[:, 1], cap_rect.y0, side="left")
+    v_above = vis_arr[:n_above]
+    in_box = (
+        (v_above[:, 3] > y_ceiling)      # Check 2: Must be largely below ceiling
+        & (v_above[:, 2] > x_min)        # Check 3: Horizontal overlap
+        & (v_above[:, 0] < x_max)
+    )
+    return np.flatnonzero(in_box)
+
+def make_page_pool():
+    """
+    Creates the process pool for page extraction. Meant to be created once per
+    run and shared across papers, so worker start-up is paid only once.
+    Returns None on single-core hosts (pages are then processed inline).
+    """
+    if PAGE_WORKERS <= 1:
+        return None
+    # "spawn": the caller is multi-threaded (pipeline, Gemini threads), and
+    # forking a threaded process can deadlock the child on inherited locks.
+    return ProcessPoolExecutor(max_workers=PAGE_WORKERS,
+                               mp_context=multiprocessing.get_context("spawn"))
 
-def extract_images_from_pdf(pdf_path, output_dir, min_size=50000, min_dim=400):
+def extract_images_from_pdf(pdf_path, output_dir, min_size=50000, min_dim=400,
+                            pdf_bytes=None, paper_basename=None, pool=None):
     """
     Extracts figures by finding the 'gap' between the Caption and the Body Text above it.
+    If pool (from make_page_pool) is given, pages are split into one chunk per
+    worker and processed in parallel; otherwise they are processed inline.
+    If pdf_bytes is given the PDF is read from memory and pdf_path may be None;
+    paper_basename then names the output files.
+    """
+    source = pdf_bytes if pdf_bytes is not None else pdf_path
+    if paper_basename is None:
+        paper_basename = os.path.splitext(os.path.basename(pdf_path))[0]
+
+    with _open_doc(source) as doc:
+        page_count = doc.page_count
+
+    if page_count == 0:
+        return []
+
+    n_chunks = min(PAGE_WORKERS, page_count) if pool is not None else 1
+    # Strided chunks spread figure-heavy stretches of a paper across workers.
+    # The PDF is shipped once per chunk, not once per page.
+    chunks = [list(range(k, page_count, n_chunks)) for k in range(n_chunks)]
+    args = (output_dir, paper_basename, min_size, min_dim)
+
+    if n_chunks == 1:
+        results = _process_pages(source, chunks[0], *args)
+    else:
+        futures = [pool.submit(_process_pages, source, chunk, *args) for chunk in chunks]
+        results = [item for f in futures for item in f.result()]
+
+    # Restore page order
+    results.sort(key=lambda x: x[0])
+    return [img for _, page_images in results for img in page_images]
+
+def _rects_to_array(rects):
+    """Packs fitz.Rects into an (N, 4) float array; empty input gives shape (0, 4)."""
+    return np.array([(r.x0, r.y0, r.x1, r.y1) for r in rects], dtype=float).reshape(-1, 4)
+
+def _is_photographic(pix, step=4):
+    """
+    Cheap color-diversity check on a subsampled pixmap. Flat diagrams reuse a
+    handful of colors; photos and gradients have mostly unique pixels.
+    """
+    if pix.n < 3 or pix.width < step or pix.height < step:
+        return False
+    rows = np.frombuffer(pix.samples, dtype=np.uint8).reshape(pix.height, pix.stride)
+    rgb = rows[::step, :pix.width * pix.n].reshape(-1, pix.width, pix.n)[:, ::step, :3].astype(np.uint32)
+    packed = (rgb[..., 0] << 16) | (rgb[..., 1] << 8) | rgb[..., 2]
+    return np.unique(packed).size > PHOTO_UNIQUE_RATIO * packed.size
+
+# Pages processed by this process, for periodic MuPDF store flushes
+_PAGES_DONE = 0
+
+def _release_page_resources():
+    global _PAGES_DONE
+    _PAGES_DONE += 1
+    if _PAGES_DONE % STORE_FLUSH_INTERVAL == 0:
+        fitz.TOOLS.store_shrink(100)
+
+def _open_doc(source):
+    if isinstance(source, (bytes, bytearray)):
+        return fitz.open(stream=source, filetype="pdf")
+    return fitz.open(source)
+
+def _process_pages(source, page_indices, output_dir, paper_basename, min_size=50000, min_dim=400):
+    """
+    Extracts figures from a chunk of pages. Runs in a worker process, so it
+    takes only picklable arguments and opens its own document once per chunk.
+    Returns list of (page_index, saved image paths).
+    """
+    with _open_doc(source) as doc:
+        return [(i, _process_page(doc, i, output_dir, paper_basename, min_size, min_dim))
+                for i in page_indices]
+
+def _process_page(doc, page_index, output_dir, paper_basename, min_size=50000, min_dim=400):
+    """
+    Extracts figures from a single page. Returns list of saved image paths.
     """
-    doc = fitz.open(pdf_path)
     extracted_images = []
-    paper_basename = os.path.splitext(os.path.basename(pdf_path))[0]
 
-    for page_index, page in enumerate(doc):
+    page = doc[page_index]
+    try:
         # 1. Analyze page structure
         captions, body_text, visuals = get_page_elements(page)
         
         if not captions:
-            continue
+            return extracted_images
             
         # Sort captions top-to-bottom
         captions.sort(key=lambda x: x[0].y0)
-        
+        page_w = page.rect.width
+
+        # Pack rects as (x0, y0, x1, y1) rows for vectorized geometry checks
+        # Sorted once per page (text by y1, visuals by y0) so each caption only
+        # scans the prefix that lies above it, found by binary search
+        text_arr = _rects_to_array(body_text)
+        text_arr = text_arr[np.argsort(text_arr[:, 3], kind="stable")]
+
+        # Target Region Finding (text geometry only, independent of visuals):
+        # We want to find the whitespace *above* each caption.
+        # It stops at the nearest Body Text or Page Top.
+        boxes = []
         for i, (cap_rect, cap_text) in enumerate(captions):
-            # Target Region Finding:
-            # We want to find the whitespace *above* this caption.
-            # It stops at the nearest Body Text or Page Top.
-            
             # Define horizontal/column bounds based on caption width
-            # If caption is wide (> 70% page width), search full width.
-            # If caption is narrow, search roughly that column (+ buffer).
-            is_wide = cap_rect.width > (page.rect.width * 0.6)
-            
-            if is_wide:
-                x_min, x_max = 0, page.rect.width
-            else:
-                x_min = cap_rect.x0 - 20
-                x_max = cap_rect.x1 + 20
+            x_min, x_max = caption_column(cap_rect, page_w)
 
             # Find Y-Limit (The ceiling)
             # Default ceiling is top of page
@@ -93,14 +233,10 @@ def extract_images_from_pdf(pdf_path, output_dir, min_size=50000, min_dim=400):
             
             # Check against Body Text to pull ceiling down
             # valid text blocks are those strictly ABOVE caption and INTERSECTING horizontal range
-            for txt_rect in body_text:
-                if txt_rect.y1 < cap_rect.y0: # Text is above caption
-                    # Check horizontal overlap
-                    if max(x_min, txt_rect.x0) < min(x_max, txt_rect.x1):
-                        # This text block is in the same column/region above us.
-                        # Push ceiling down to the bottom of this text
-                        if txt_rect.y1 > y_ceiling:
-                            y_ceiling = txt_rect.y1
+            above = text_arr[:np.searchsorted(text_arr[:, 3], cap_rect.y0, side="left")] # Text is above caption
+            h_overlap = np.maximum(x_min, above[:, 0]) < np.minimum(x_max, above[:, 2])
+            # Push ceiling down to the bottom of the lowest such text block
+            y_ceiling = float(above[h_overlap, 3].max(initial=y_ceiling))
             
             # Also check against PREVIOUS caption (don't gobble previous figure)
             if i > 0:
@@ -113,31 +249,25 @@ def extract_images_from_pdf(pdf_path, output_dir, min_size=50000, min_dim=400):
 
             # Sanity buffer
             y_ceiling += 5 
-            
+            boxes.append((x_min, x_max, y_ceiling))
+
+        # Only parse vector drawings if some caption's candidate box holds no raster;
+        # then the whole page gets them, exactly as if they were always fetched
+        vis_arr = _rects_to_array(visuals)
+        vis_order = np.argsort(vis_arr[:, 1], kind="stable")
+        vis_arr = vis_arr[vis_order]
+        if any(_visuals_in_box(vis_arr, cap_rect, *box).size == 0
+               for (cap_rect, _), box in zip(captions, boxes)):
+            visuals = visuals + get_drawing_visuals(page)
+            vis_arr = _rects_to_array(visuals)
+            vis_order = np.argsort(vis_arr[:, 1], kind="stable")
+            vis_arr = vis_arr[vis_order]
+        
+        for (cap_rect, cap_text), (x_min, x_max, y_ceiling) in zip(captions, boxes):
             # Now we have a "Candidate Box" = [x_min, y_ceiling, x_max, cap_rect.y0]
             # Identify all visuals strictly inside or significantly overlapping this box
-            candidate_visuals = []
-            
-            # We search slightly above the caption to valid ceiling
-            search_rect = fitz.Rect(x_min, y_ceiling, x_max, cap_rect.y0)
-            
-            for v_rect in visuals:
-                # We want visuals that are mostly inside the vertical region
-                # Intersection area check?
-                
-                # Check 1: Must be largely above caption
-                if v_rect.y0 >= cap_rect.y0: 
-                    continue # This visual is below the caption logic line
-                
-                # Check 2: Must be largely below ceiling
-                if v_rect.y1 <= y_ceiling:
-                    continue
-                
-                # Check 3: Horizontal overlap
-                if not (v_rect.x1 > x_min and v_rect.x0 < x_max):
-                    continue
-                    
-                candidate_visuals.append(v_rect)
+            # We want visuals that are mostly inside the vertical region
+            candidate_visuals = [visuals[k] for k in vis_order[_visuals_in_box(vis_arr, cap_rect, x_min, x_max, y_ceiling)]]
             
             if not candidate_visuals:
                 continue
@@ -164,21 +294,40 @@ def extract_images_from_pdf(pdf_path, output_dir, min_size=50000, min_dim=400):
                 continue
 
             try:
+                # Cheap low-DPI probe first; most rejects never get a full render
+                pix_lo = page.get_pixmap(clip=final_bbox, alpha=False, dpi=PROBE_DPI)
+                scale = (RENDER_DPI / PROBE_DPI) ** 2
+                est_size = pix_lo.width * pix_lo.height * pix_lo.n * scale
+                pix_lo = None # release C-side buffer
+                
+                if est_size < min_size:
+                    continue
+
                 # Render (Fixes black background vs raw extraction)
-                pix = page.get_pixmap(clip=final_bbox, alpha=False, dpi=150)
+                pix = page.get_pixmap(clip=final_bbox, alpha=False, dpi=RENDER_DPI)
                 
                 if pix.size < min_size:
                     continue
                 
                 safe_cap = re.sub(r'[^\w\-]', '_', cap_text.split('\n')[0][:25])
-                img_filename = f"{paper_basename}_p{page_index}_{safe_cap}.png"
+                # Photographic/gradient-rich figures are far smaller and faster as JPEG
+                ext = "jpg" if _is_photographic(pix) else "png"
+                img_filename = f"{paper_basename}_p{page_index}_{safe_cap}.{ext}"
                 img_path = os.path.join(output_dir, img_filename)
                 
-                pix.save(img_path)
+                if ext == "jpg":
+                    pix.save(img_path, jpg_quality=JPEG_QUALITY)
+                else:
+                    pix.save(img_path)
                 pix = None
                 
                 extracted_images.append(img_path)
             except Exception as e:
                 print(f"[!] Error on {cap_text}: {e}")
+    finally:
+        # Drop the page and periodically empty MuPDF's shared store so RSS
+        # stays flat across long documents and parallel workers
+        page = None
+        _release_page_resources()
 
     return extracted_images
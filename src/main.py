@@ -1,9 +1,16 @@
 import os
-import json
+import orjson
 import crawler
 import extractor
 import analyzer
 import shutil
+import argparse
+import pickle
+import tempfile
+import aiofiles
+import imagehash
+import numpy as np
+from PIL import Image
 from dotenv import load_dotenv
 
 # Resolve paths relative to this script file to be robust
@@ -13,51 +20,339 @@ DATA_DIR = os.path.join(PROJECT_ROOT, "data")
 PAPERS_DIR = os.path.join(DATA_DIR, "papers")
 FIGURES_DIR = os.path.join(DATA_DIR, "figures")
 HISTORY_FILE = os.path.join(DATA_DIR, "history.json")
+INDEX_STATE_FILE = os.path.join(DATA_DIR, "index_state.pkl")
+# Append-only metadata shard: one JSON line per saved figure
+META_SHARD = os.path.join(FIGURES_DIR, "_meta.jsonl")
+
+# Max images sent to Gemini in a single request
+BATCH_SIZE = 8
+
+# Local pre-screen thresholds on a 128x128 HSV thumbnail (0-255 scale)
+PREFILTER_MIN_SATURATION = 6   # mean S below this ~ grayscale (criterion #7)
+PREFILTER_MIN_VALUE_STD = 10   # std of V below this ~ flat / near-uniform
+
+# Perceptual-hash Hamming distance at or below which two figures are duplicates
+DEDUPE_MAX_DISTANCE = 4
 
 def load_history():
     if os.path.exists(HISTORY_FILE):
-        with open(HISTORY_FILE, 'r') as f:
-            return json.load(f)
+        with open(HISTORY_FILE, 'rb') as f:
+            return orjson.loads(f.read())
     return {"processed_ids": []}
 
 def save_history(history):
-    with open(HISTORY_FILE, 'w') as f:
-        json.dump(history, f, indent=2)
+    with open(HISTORY_FILE, 'wb') as f:
+        f.write(orjson.dumps(history, option=orjson.OPT_INDENT_2))
 
+import asyncio
 import concurrent.futures
+import queue
+import threading
+
+# Serializes appends to META_SHARD across analysis threads
+_META_LOCK = threading.Lock()
+
+# Max downloaded PDFs waiting for extraction (bounds memory usage)
+PDF_QUEUE_SIZE = 2
+
+# Max concurrent PDF downloads when processing several papers
+DOWNLOAD_CONCURRENCY = 8
+
+# Max concurrent sidecar reads in sync_dataset_index
+SIDECAR_READ_CONCURRENCY = 64
+
+def remove_file(path):
+    """Deletes a temp file, first dropping its pages from the OS page cache."""
+    try:
+        if hasattr(os, "posix_fadvise"):
+            fd = os.open(path, os.O_RDONLY)
+            try:
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+            finally:
+                os.close(fd)
+        os.remove(path)
+    except OSError:
+        pass
+
+def cleanup_worker(cleanup_q):
+    """Single thread that serializes temp-file deletions until it reads None."""
+    while True:
+        path = cleanup_q.get()
+        if path is None:
+            break
+        remove_file(path)
+
+def purge_orphans():
+    """Removes leftover candidate images in PAPERS_DIR (e.g. from a crashed run)."""
+    if not os.path.isdir(PAPERS_DIR):
+        return
+    orphans = [f for f in os.listdir(PAPERS_DIR) if f.endswith(extractor.IMAGE_EXTENSIONS)]
+    for f in orphans:
+        remove_file(os.path.join(PAPERS_DIR, f))
+    if orphans:
+        print(f"    [Cleanup] Purged {len(orphans)} orphaned images from {PAPERS_DIR}")
+
+def dedupe_images(img_paths, max_distance=DEDUPE_MAX_DISTANCE, discard=remove_file):
+    """
+    Drops near-duplicate figures within a paper (e.g. a teaser repeated in the
+    appendix) using perceptual hashes. Keeps the first occurrence and discards
+    the rest from disk. Returns the kept paths in original order.
+    """
+    kept, kept_hashes = [], []
+    for p in img_paths:
+        try:
+            with Image.open(p) as img:
+                h = imagehash.phash(img)
+        except Exception as e:
+            print(f"    [!] Could not hash {p}: {e}")
+            kept.append(p)
+            continue
+
+        if any(h - other <= max_distance for other in kept_hashes):
+            print(f"    [-] DUPLICATE: {os.path.basename(p)}")
+            discard(p)
+            continue
+
+        kept.append(p)
+        kept_hashes.append(h)
+    return kept
+
+def prefilter_image(img_path):
+    """
+    Cheap local check for obvious rejects (grayscale or flat images).
+    Returns a synthetic reject result, or None if the image should go to Gemini.
+    """
+    try:
+        with Image.open(img_path) as img:
+            thumb = np.asarray(img.convert('RGB').resize((128, 128)).convert('HSV'))
+    except Exception as e:
+        print(f"    [!] Prefilter could not read {img_path}: {e}")
+        return None
+
+    if thumb[:, :, 1].mean() < PREFILTER_MIN_SATURATION or thumb[:, :, 2].std() < PREFILTER_MIN_VALUE_STD:
+        return {"is_methodology": False, "quality_score": 0, "reason": "grayscale/flat prefilter"}
+    return None
+
+def analyze_batch(img_paths, use_cache=True):
+    """
+    Helper to analyze a batch of images with one Gemini request.
+    Obvious rejects are screened out locally, and cached verdicts are served
+    from disk without touching Gemini.
+    Returns list of (img_path, result) pairs.
+    """
+    results = {p: prefilter_image(p) for p in img_paths}
+    to_analyze = [p for p in img_paths if results[p] is None]
+
+    if to_analyze:
+        names = ", ".join(os.path.basename(p) for p in to_analyze)
+        print(f"    [Thread] Analyzing {len(to_analyze)} images: {names}...", flush=True)
+        for p, r in zip(to_analyze, analyzer.analyze_images_batch(to_analyze, use_cache=use_cache)):
+            results[p] = r
+
+    return [(p, results[p]) for p in img_paths]
 
-def process_one_image(img_path, paper_id):
+def process_one_image(img_path, paper_id, result, discard=remove_file):
     """
-    Helper to process a single image: Analyze -> Save/Delete.
+    Helper to dispatch a single analyzed image: Save/Delete.
+    Rejected images are handed to discard (by default deleted inline).
     Returns 1 if saved, 0 if skipped/deleted.
     """
     try:
         filename = os.path.basename(img_path)
-        print(f"    [Thread] Analyzing {filename}...", flush=True)
-        result = analyzer.analyze_image(img_path)
         
         if result.get("is_methodology") and result.get("quality_score", 0) >= 8:
             # Move to figures dir
             dest_name = f"{paper_id}_{filename}"
             dest_path = os.path.join(FIGURES_DIR, dest_name)
-            shutil.move(img_path, dest_path)
+            try:
+                os.rename(img_path, dest_path)
+            except OSError:
+                # data/papers and data/figures on different filesystems
+                shutil.move(img_path, dest_path)
             
             # Save metadata
-            with open(dest_path + ".json", 'w') as f:
-                json.dump(result, f, indent=2)
+            append_meta({**result, 'filename': dest_name})
             
             print(f"    [+] KEEP: {filename} (Score: {result.get('quality_score')})")
             return 1
         else:
             # Cleanup rejected
-            os.remove(img_path)
+            discard(img_path)
             print(f"    [-] SKIP: {filename} ({result.get('reason', 'low quality')})")
             return 0
     except Exception as e:
         print(f"    [!] Error analyzing {img_path}: {e}")
         return 0
 
+def append_meta(record):
+    line = orjson.dumps(record) + b"\n"
+    with _META_LOCK:
+        with open(META_SHARD, 'ab') as f:
+            f.write(line)
+
+def load_meta_shard():
+    """
+    Returns ({filename: meta}, number of lines read) from META_SHARD.
+    Later lines win when a filename appears more than once.
+    """
+    metas = {}
+    n_lines = 0
+    if not os.path.exists(META_SHARD):
+        return metas, n_lines
+    with open(META_SHARD, 'rb') as f:
+        for n, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            n_lines += 1
+            try:
+                meta = orjson.loads(line)
+                metas[meta['filename']] = meta
+            except Exception as e:
+                print(f"    [Sync] Corrupt metadata line {n} in {os.path.basename(META_SHARD)}: {e}")
+    return metas, n_lines
+
+def rewrite_meta_shard(metas):
+    """Atomically replaces META_SHARD with one line per entry in metas."""
+    fd, tmp_path = tempfile.mkstemp(dir=FIGURES_DIR, suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.writelines(orjson.dumps(m) + b"\n" for m in metas.values())
+        with _META_LOCK:
+            os.replace(tmp_path, META_SHARD)
+    except Exception as e:
+        print(f"    [Sync] Could not compact metadata shard: {e}")
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+
+def run_pipeline(papers, max_workers, use_cache=True):
+    """
+    Runs papers through a three-stage producer/consumer pipeline so that
+    network, CPU and Gemini latency overlap across papers:
+      A. download PDFs        -> extract_q
+      B. extract images       -> analyze_q
+      C. analyze with Gemini  (ThreadPoolExecutor)
+    Returns {paper_id: saved_count} for papers that went through every stage.
+    """
+    extract_q = queue.Queue(maxsize=PDF_QUEUE_SIZE)
+    # Bounded so extraction can't race ahead of Gemini and fill data/papers
+    analyze_q = queue.Queue(maxsize=max_workers)
+    # Caps batches handed to the executor (its own queue is unbounded)
+    slots = threading.Semaphore(max_workers)
+    cleanup_q = queue.Queue()
+
+    # Per-paper counters: batches still in flight + figures saved
+    lock = threading.Lock()
+    pending = {}
+    saved = {}
+    completed = {}
+
+    def finish_batch(paper_id, n_saved):
+        with lock:
+            saved[paper_id] += n_saved
+            pending[paper_id] -= 1
+            if pending[paper_id] == 0:
+                completed[paper_id] = saved[paper_id]
+                print(f"    [Done] {paper_id}: saved {saved[paper_id]} figures.", flush=True)
+
+    def on_downloaded(paper, pdf_bytes):
+        if pdf_bytes is not None:
+            extract_q.put((pdf_bytes, paper['id']))
+
+    def download_stage():
+        try:
+            if len(papers) == 1:
+                # Single-paper mode: plain synchronous download
+                paper = papers[0]
+                print(f"\n[=] Downloading: {paper['title']} ({paper['id']})", flush=True)
+                on_downloaded(paper, crawler.download_pdf(paper['pdf_url']))
+            else:
+                asyncio.run(crawler.download_all(papers, on_downloaded, DOWNLOAD_CONCURRENCY))
+        finally:
+            extract_q.put(None)
+
+    def extract_stage():
+        try:
+            while True:
+                item = extract_q.get()
+                if item is None:
+                    break
+                pdf_bytes, paper_id = item
+                print(f"    [{paper_id}] Extracting images...", flush=True)
+                try:
+                    raw_images = extractor.extract_images_from_pdf(
+                        None, PAPERS_DIR, pdf_bytes=pdf_bytes, paper_basename=paper_id,
+                        pool=page_pool)
+                except Exception as e:
+                    print(f"    [!] Extraction failed for {paper_id}: {e}")
+                    continue
+
+                raw_images = dedupe_images(raw_images, discard=cleanup_q.put)
+                batches = [raw_images[i:i + BATCH_SIZE] for i in range(0, len(raw_images), BATCH_SIZE)]
+                print(f"    [{paper_id}] Found {len(raw_images)} candidate images in {len(batches)} batch(es).", flush=True)
+                with lock:
+                    saved[paper_id] = 0
+                    pending[paper_id] = len(batches)
+                    if not batches:
+                        completed[paper_id] = 0
+                for batch in batches:
+                    analyze_q.put((batch, paper_id))
+        finally:
+            analyze_q.put(None)
+
+    def analyze_job(batch, paper_id):
+        n_saved = 0
+        try:
+            for img, result in analyze_batch(batch, use_cache):
+                n_saved += process_one_image(img, paper_id, result, discard=cleanup_q.put)
+        finally:
+            finish_batch(paper_id, n_saved)
+            slots.release()
+
+    def log_failure(future):
+        e = future.exception()
+        if e is not None:
+            print(f"    [!] Analysis job failed: {e!r}", flush=True)
+
+    def analyze_stage():
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            while True:
+                item = analyze_q.get()
+                if item is None:
+                    break
+                slots.acquire()
+                executor.submit(analyze_job, *item).add_done_callback(log_failure)
+
+    purge_orphans()
+    # One page-extraction pool for the whole run (worker start-up paid once)
+    page_pool = extractor.make_page_pool()
+    cleaner = threading.Thread(target=cleanup_worker, args=(cleanup_q,), name="cleanup")
+    cleaner.start()
+
+    threads = [threading.Thread(target=download_stage, name="download"),
+               threading.Thread(target=extract_stage, name="extract"),
+               threading.Thread(target=analyze_stage, name="analyze")]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    if page_pool is not None:
+        page_pool.shutdown()
+    cleanup_q.put(None)
+    cleaner.join()
+    purge_orphans()
+
+    return completed
+
 def main():
+    parser = argparse.ArgumentParser(description="Scientific Methodology Figure Extractor")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="Ignore cached Gemini verdicts in data/analysis_cache and re-query")
+    args = parser.parse_args()
+    use_cache = not args.no_cache
+
     load_dotenv()
     api_key = os.getenv("GOOGLE_API_KEY")
     if not api_key:
@@ -85,7 +380,7 @@ def main():
         count = 1
     
     try:
-        max_workers = int(input("Max concurrent threads (default 4): ").strip())
+        max_workers = max(1, int(input("Max concurrent threads (default 4): ").strip()))
     except:
         max_workers = 4
 
@@ -93,74 +388,86 @@ def main():
     papers = crawler.fetch_papers(query, max_results=count, saved_ids=processed_ids)
     print(f"[*] Found {len(papers)} new papers to process.")
 
-    for paper in papers:
-        print(f"\n[=] Processing: {paper['title']} ({paper['id']})")
-        
-        # Download
-        pdf_name = f"{paper['id']}.pdf"
-        pdf_path = os.path.join(PAPERS_DIR, pdf_name)
-        
-        if not crawler.download_pdf(paper['pdf_url'], pdf_path):
-            continue
-
-        # Extract
-        print("    Extracting images...")
-        raw_images = extractor.extract_images_from_pdf(pdf_path, PAPERS_DIR) 
-        print(f"    Found {len(raw_images)} candidate images. Analyzing with {max_workers} threads...")
-
-        # Analyze (Multi-threaded)
-        saved_count = 0
-        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
-            # Create a future for each image
-            futures = {executor.submit(process_one_image, img, paper['id']): img for img in raw_images}
-            
-            for future in concurrent.futures.as_completed(futures):
-                saved_count += future.result()
+    # 2. Download -> Extract -> Analyze, overlapped across papers
+    completed = run_pipeline(papers, max_workers, use_cache)
 
-        # Cleanup PDF to save space
-        try:
-            os.remove(pdf_path)
-            print(f"    [Cleanup] Deleted temporary PDF: {pdf_name}")
-        except OSError as e:
-            print(f"    [Warning] Could not delete PDF: {e}")
-        
-        # Update History (JSON for code, MD for human)
-        processed_ids.add(paper['id'])
-        history["processed_ids"] = list(processed_ids)
-        save_history(history)
-        
-        # Append to human-readable log (Legacy, we now use sync_dataset_index)
-        # log_file = os.path.join(DATA_DIR, "history.md")
-        # with open(log_file, "a", encoding="utf-8") as f:
-        #     f.write(f"- **{paper['id']}**: {paper['title']} ({saved_count} figures saved)\n")
+    # Update History once every stage has finished (JSON for code, MD for human)
+    processed_ids.update(completed)
+    history["processed_ids"] = list(processed_ids)
+    save_history(history)
+    print(f"\n[*] Completed {len(completed)}/{len(papers)} papers, "
+          f"saved {sum(completed.values())} figures.")
 
-        print(f"    Saved {saved_count} figures from this paper.")
-    
     # Final Step: Sync the detailed index
     print("\n[Index] Syncing dataset index and checking for deleted files...")
     sync_dataset_index()
     print("[Done] Dataset updated.")
 
+def load_index_state():
+    """Returns {sidecar filename: (mtime, parsed meta)} from the last sync."""
+    if os.path.exists(INDEX_STATE_FILE):
+        try:
+            with open(INDEX_STATE_FILE, 'rb') as f:
+                return pickle.load(f)
+        except Exception as e:
+            print(f"    [Sync] Ignoring unreadable index state: {e}")
+    return {}
+
+def save_index_state(state):
+    fd, tmp_path = tempfile.mkstemp(dir=DATA_DIR, suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, INDEX_STATE_FILE)
+    except Exception as e:
+        print(f"    [Sync] Could not save index state: {e}")
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+
+async def _load_all(json_paths, concurrency=SIDECAR_READ_CONCURRENCY):
+    """
+    Reads and parses sidecar JSON files concurrently.
+    Returns parsed dicts in input order; failures are returned as the exception.
+    """
+    sem = asyncio.Semaphore(concurrency)
+
+    async def load(path):
+        async with sem:
+            try:
+                async with aiofiles.open(path, 'rb') as f:
+                    data = await f.read()
+                return orjson.loads(data)
+            except Exception as e:
+                return e
+
+    return await asyncio.gather(*(load(p) for p in json_paths))
+
 def sync_dataset_index():
     """
     Rebuilds dataset_index.md based on actual files in figures/.
-    Removes sidecar .json if the image was manually deleted.
+    Metadata comes from the _meta.jsonl shard plus any legacy per-figure
+    .json sidecars. Drops metadata whose image was manually deleted.
+    Only sidecars whose mtime changed since the last sync are re-parsed.
     """
     index_file = os.path.join(DATA_DIR, "dataset_index.md")
+    prev_state = load_index_state()
+    state = {}
     
     # 1. Scan for consistency
-    all_files = os.listdir(FIGURES_DIR)
+    all_files = set(os.listdir(FIGURES_DIR))
     json_files = [f for f in all_files if f.endswith('.json')]
     
     valid_entries = []
+    to_parse = []
     
     for jf in json_files:
         json_path = os.path.join(FIGURES_DIR, jf)
         img_filename = jf[:-5] # remove .json
-        img_path = os.path.join(FIGURES_DIR, img_filename)
         
         # Check if image still exists
-        if not os.path.exists(img_path):
+        if img_filename not in all_files:
             print(f"    [Sync] Orphaned metadata found, removing: {jf}")
             try:
                 os.remove(json_path)
@@ -168,14 +475,43 @@ def sync_dataset_index():
                 pass
             continue
             
-        # Read metadata
+        # Reuse the cached parse if the sidecar is unchanged
         try:
-            with open(json_path, 'r') as f:
-                meta = json.load(f)
-                meta['filename'] = img_filename
-                valid_entries.append(meta)
-        except Exception as e:
+            mtime = os.stat(json_path).st_mtime
+        except OSError as e:
             print(f"    [Sync] Corrupt metadata {jf}: {e}")
+            continue
+        cached = prev_state.get(jf)
+        if cached is not None and cached[0] == mtime:
+            state[jf] = cached
+            valid_entries.append(cached[1])
+        else:
+            to_parse.append((jf, mtime))
+
+    # Read changed sidecars concurrently
+    if to_parse:
+        paths = [os.path.join(FIGURES_DIR, jf) for jf, _ in to_parse]
+        loaded = asyncio.run(_load_all(paths))
+        for (jf, mtime), meta in zip(to_parse, loaded):
+            if not isinstance(meta, dict):
+                print(f"    [Sync] Corrupt metadata {jf}: {meta}")
+                continue
+            meta['filename'] = jf[:-5]
+            state[jf] = (mtime, meta)
+            valid_entries.append(meta)
+
+    save_index_state(state)
+
+    # Shard entries: read in one shot, reconcile against actual images
+    shard, n_lines = load_meta_shard()
+    live = {fn: m for fn, m in shard.items() if fn in all_files}
+    for fn in shard.keys() - live.keys():
+        print(f"    [Sync] Orphaned metadata found, removing: {fn}")
+    # Compact away orphans, superseded and corrupt lines
+    if n_lines != len(live):
+        rewrite_meta_shard(live)
+    sidecar_names = {m['filename'] for m in valid_entries}
+    valid_entries.extend(m for fn, m in live.items() if fn not in sidecar_names)
 
     # 2. Sort entries (by filename or score?) - let's do filename (date implicit)
     valid_entries.sort(key=lambda x: x['filename'], reverse=True)